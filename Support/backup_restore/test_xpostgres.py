@@ -16,8 +16,10 @@ Tests for the C{xpostgres} tool.
 """
 
 import os
+import errno
 import plistlib
 import re
+import threading
 
 from twisted.trial.unittest import TestCase
 
@@ -42,6 +44,11 @@ from twisted.runner.test.test_procmon import DummyProcessReactor as _Parent
 import xpostgres
 from xpostgres import XPostgres, ControlServer
 from xpostgres import XPGCtl
+from xpostgres import dispatch_token
+from xpostgres import XPGArchive
+from xpostgres import COPY_BUFFER_SIZE
+from xpostgres import _threaded_copy
+from xpostgres import _read_write_copy
 from xpostgres import CtlStart
 from xpostgres import NoDataDirectory
 from xpostgres import DEFAULT_SOCKET_DIR
@@ -897,3 +904,242 @@ class XPGCtlTest(TestCase):
         cmdobj = pgctl.command_object
         self.assertIsInstance(cmdobj, CtlStart)
         self.assertEquals(cmdobj.xpg_ctl.wait, True)
+
+
+
+class DispatchTest(TestCase):
+    """
+    Tests for L{dispatch_token}.
+    """
+    def test_ctl(self):
+        """
+        Running as C{xpg_ctl}, or with C{BEHAVE_AS_XPG_CTL} set, means
+        C{xpg_ctl}; the variable is not passed on.
+        """
+        self.assertEquals(dispatch_token(["/usr/bin/xpg_ctl", "start"], {}),
+                          "ctl")
+        environ = {"BEHAVE_AS_XPG_CTL": "1"}
+        self.assertEquals(dispatch_token(["xpostgres", "archive"], environ),
+                          "ctl")
+        self.assertEquals(environ, {})
+
+
+    def test_archive(self):
+        """
+        The C{archive} and C{archive-batch} subcommands are recognized.
+        """
+        self.assertEquals(dispatch_token(["xpostgres", "archive"], {}),
+                          "archive")
+        self.assertEquals(dispatch_token(["xpostgres", "archive-batch"], {}),
+                          "archive-batch")
+
+
+    def test_xpostgres(self):
+        """
+        Anything else runs C{xpostgres} itself.
+        """
+        self.assertEquals(dispatch_token(["xpostgres", "-D", "data"], {}), "")
+        self.assertEquals(dispatch_token(["xpostgres"], {}), "")
+
+
+
+class XPGArchiveTest(TestCase):
+    """
+    Tests for the C{archive} subcommand, used as postgres's
+    C{archive_command}.
+    """
+    def setUp(self):
+        self.source = FilePath(self.mktemp())
+        self.source.setContent("some WAL data")
+        self.destination = FilePath(self.mktemp())
+        self.destination.createDirectory()
+        self.destination = self.destination.child("000000010000000000000001")
+
+
+    def archive(self):
+        """
+        Archive C{self.source} to C{self.destination}, returning the exit
+        status.
+        """
+        return XPGArchive(None).do_everything(
+            ["xpostgres", "archive", self.source.path, self.destination.path],
+            {}
+        )
+
+
+    def test_archive_copies(self):
+        """
+        L{XPGArchive.do_everything} copies its source to its destination,
+        readable only by its owner, leaving no temporary files behind.
+        """
+        self.assertEquals(self.archive(), 0)
+        self.assertEquals(self.destination.getContent(), "some WAL data")
+        self.assertEquals(self.destination.getPermissions().shorthand(),
+                          "rw-------")
+        self.assertEquals(self.destination.parent().listdir(),
+                          [self.destination.basename()])
+
+
+    def test_archive_copies_large(self):
+        """
+        L{XPGArchive.do_everything} copies all of a source which is too large
+        to map into memory, by cloning it where the filesystem can, and
+        otherwise by C{sendfile(2)} on Linux or C{fcopyfile(3)} on Darwin.
+        """
+        content = "0123456789" * (COPY_BUFFER_SIZE // 4)
+        self.source.setContent(content)
+        self.assertEquals(self.archive(), 0)
+        self.assertEquals(self.destination.getContent(), content)
+
+
+    def copy_by_hand(self, copy):
+        """
+        Copy C{self.source}, several copying buffers long plus a remainder, to
+        C{self.destination} with C{copy}, passing it both files' descriptors
+        and the size, and check that it copied every byte in order without
+        leaving any thread behind.
+        """
+        content = "".join(chr(ord("a") + i) * COPY_BUFFER_SIZE
+                          for i in range(3)) + "remainder"
+        self.source.setContent(content)
+        threads = threading.active_count()
+        with self.source.open() as original:
+            with self.destination.open("w") as copied:
+                copy(original.fileno(), copied.fileno(), len(content))
+        self.assertEquals(self.destination.getContent(), content)
+        self.assertEquals(threading.active_count(), threads)
+
+
+    def test_threaded_copy(self):
+        """
+        L{_threaded_copy} copies all of a file larger than its buffers.
+        """
+        self.copy_by_hand(_threaded_copy)
+
+
+    def test_read_write_copy(self):
+        """
+        L{_read_write_copy} copies all of a file larger than its buffer.
+        """
+        self.copy_by_hand(
+            lambda in_fd, out_fd, size: _read_write_copy(in_fd, out_fd)
+        )
+
+
+    def test_threaded_copy_read_error(self):
+        """
+        If reading fails, L{_threaded_copy} raises the reader's exception,
+        and doesn't leave the reading thread behind.
+        """
+        threads = threading.active_count()
+        in_fd = os.open(self.destination.parent().path, os.O_RDONLY)
+        self.addCleanup(os.close, in_fd)
+        with self.destination.open("w") as output:
+            error = self.assertRaises(IOError, _threaded_copy, in_fd,
+                                      output.fileno(), COPY_BUFFER_SIZE)
+        self.assertEquals(error.errno, errno.EISDIR)
+        self.assertEquals(threading.active_count(), threads)
+
+
+    def test_archive_existing(self):
+        """
+        L{XPGArchive.do_everything} leaves a destination which is already the
+        same size as its source alone.
+        """
+        self.destination.setContent("same size, ok.")
+        self.source.setContent("same size, ok!")
+        self.archive()
+        self.assertEquals(self.destination.getContent(), "same size, ok.")
+
+
+    def test_archive_replaces_wrong_size(self):
+        """
+        L{XPGArchive.do_everything} replaces a destination whose size differs
+        from its source, and leaves no in-progress file behind.
+        """
+        self.destination.setContent("old")
+        self.archive()
+        self.assertEquals(self.destination.getContent(), "some WAL data")
+        self.assertEquals(self.destination.parent().listdir(),
+                          [self.destination.basename()])
+
+
+    def batch_with_input(self, data):
+        """
+        Run L{XPGArchive.archive_batch} with C{data} as its input.
+
+        @return: its exit status and report.
+        """
+        pairs = FilePath(self.mktemp())
+        pairs.setContent(data)
+        report = FilePath(self.mktemp())
+        with pairs.open() as pairs_file:
+            with report.open("w") as report_file:
+                status = XPGArchive(None).archive_batch(pairs_file.fileno(),
+                                                        report_file.fileno())
+        return status, report.getContent()
+
+
+    def test_archive_batch(self):
+        """
+        L{XPGArchive.archive_batch} archives each pair of source and
+        destination paths that it reads, and reports on each.
+        """
+        other = self.source.sibling("other")
+        other.setContent("other WAL data")
+        otherDestination = self.destination.sibling("000000010000000000000002")
+        status, report = self.batch_with_input(
+            "\0".join([self.source.path, self.destination.path,
+                       other.path, otherDestination.path, ""])
+        )
+        self.assertEquals(status, 0)
+        self.assertEquals(self.destination.getContent(), "some WAL data")
+        self.assertEquals(otherDestination.getContent(), "other WAL data")
+        self.assertEquals(report,
+                          "0 " + self.source.path + "\n0 " + other.path + "\n")
+
+
+    def test_archive_batch_unterminated(self):
+        """
+        If L{XPGArchive.archive_batch}'s input ends partway through a path, it
+        reports a failure for that segment.
+        """
+        status, report = self.batch_with_input(
+            self.source.path + "\0" + self.destination.path
+        )
+        self.assertEquals((status, report), (1, "1 " + self.source.path + "\n"))
+        self.assertFalse(self.destination.exists())
+        status, report = self.batch_with_input(self.source.path)
+        self.assertEquals((status, report), (1, "1 " + self.source.path + "\n"))
+
+
+    def test_archive_batch_no_destination(self):
+        """
+        If L{XPGArchive.archive_batch}'s input ends with a source but no
+        destination, it reports a failure for that source.
+        """
+        status, report = self.batch_with_input(self.source.path + "\0")
+        self.assertEquals((status, report), (1, "1 " + self.source.path + "\n"))
+
+
+    def test_archive_batch_retry(self):
+        """
+        When L{XPGArchive.archive_batch} fails to archive a segment, it
+        removes its temporary file, so that archiving the same segment again
+        in the same process can succeed.
+        """
+        clone_file = xpostgres._clone_file
+        def fail_once(src, dst):
+            self.patch(xpostgres, "_clone_file", clone_file)
+            FilePath(dst).setContent("partial")
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+        self.patch(xpostgres, "_clone_file", fail_once)
+        pair = self.source.path + "\0" + self.destination.path + "\0"
+        status, report = self.batch_with_input(pair * 2)
+        self.assertEquals(status, 1)
+        self.assertEquals(report,
+                          "1 " + self.source.path + "\n0 " + self.source.path +
+                          "\n")
+        self.assertEquals(self.destination.getContent(), "some WAL data")
+        self.assertEquals(self.destination.parent().listdir(),
+                          [self.destination.basename()])
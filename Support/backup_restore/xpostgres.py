@@ -19,14 +19,23 @@ from __future__ import print_function
 
 import os
 import re
+import errno
+import fcntl
 import itertools
 import sys
 import getopt
 import datetime
 import json
+import io
+import mmap
+import ctypes
+import struct
+import threading
 
 from shlex import split as shell_split
 
+from Queue import Queue
+
 from plistlib import readPlist
 
 from subprocess import Popen, PIPE
@@ -99,6 +108,28 @@ MAINTAINED_LOG_COUNT    = 4
 HEARTBEAT_SECS          = 10
 XPG_SOCKET_NAME = ".xpg.skt"
 TEMP_EXT = '.in-progress'
+SENDFILE_CHUNK = 1 << 30        # bytes per sendfile() call
+COPY_BUFFER_SIZE = 4 * 1024 ** 2 # bytes per read() when copying by hand
+COPY_BUFFER_COUNT = 4           # buffers shared by the reader and writer
+MMAP_COPY_LIMIT = 64 * 1024     # files smaller than this are copied by mmap()
+
+# From <copyfile.h>:
+COPYFILE_DATA = 1 << 3
+# From <sys/fcntl.h> on Darwin:
+F_PREALLOCATE = 42
+F_ALLOCATECONTIG = 0x2
+F_ALLOCATEALL = 0x4
+F_PEOFPOSMODE = 3
+F_NOCACHE = 48
+# From <linux/fs.h>:
+FICLONE = 0x40049409
+# From <linux/fadvise.h>:
+POSIX_FADV_DONTNEED = 4
+
+# Errors with which a clone fails because the filesystem (or operating system)
+# can't make one, rather than because something is actually wrong.
+CLONE_UNSUPPORTED = (errno.EXDEV, errno.ENOTSUP, errno.EOPNOTSUPP,
+                     errno.EINVAL, errno.ENOTTY)
 
 # From postgres itself:
 LOCK_FILE_LINE_SOCKET_DIR = 5
@@ -1726,42 +1757,469 @@ class XPGCtl(object):
 
 
 
+LIBC = ctypes.CDLL(None, use_errno=True)
+if sys.platform.startswith('linux'):
+    LIBC.sendfile64.restype = ctypes.c_ssize_t
+    LIBC.sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                ctypes.POINTER(ctypes.c_int64),
+                                ctypes.c_size_t]
+    LIBC.posix_fadvise64.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                     ctypes.c_int64, ctypes.c_int]
+    LIBC.fallocate64.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                                 ctypes.c_int64]
+
+
+
+def _libc_error():
+    """
+    Describe the error left behind by a failed C library call.
+
+    @rtype: L{OSError}
+    """
+    code = ctypes.get_errno()
+    return OSError(code, os.strerror(code))
+
+
+
+def _fcopyfile(in_fd, out_fd):
+    """
+    Copy the data of one open file to another with Darwin's C{fcopyfile(3)}.
+    """
+    if LIBC.fcopyfile(in_fd, out_fd, None, COPYFILE_DATA) < 0:
+        raise _libc_error()
+
+
+
+def _ficlone(in_fd, out_fd):
+    """
+    Make C{out_fd} share all of C{in_fd}'s data blocks, with Linux's
+    C{FICLONE} ioctl.
+    """
+    try:
+        fcntl.ioctl(out_fd, FICLONE, in_fd)
+    except IOError as e:
+        raise OSError(e.errno, e.strerror)
+
+
+
+def _clone_file(src_path, dst_path):
+    """
+    Create C{dst_path}, accessible only by its owner, as a copy-on-write
+    clone of C{src_path}, which takes the same (tiny) amount of time however
+    large the file is, since no data is copied.
+
+    @param src_path: The path of the file to clone.
+    @type src_path: L{bytes}
+
+    @param dst_path: The path of the clone; nothing may exist there yet.
+    @type dst_path: L{bytes}
+
+    @raise OSError: if no clone could be made.  If its C{errno} is in
+        L{CLONE_UNSUPPORTED}, the filesystem can't make clones and the file
+        should be copied instead.
+    """
+    if sys.platform == 'darwin':
+        try:
+            clonefile = LIBC.clonefile
+        except AttributeError:
+            # Before 10.12, there's no such thing.
+            raise OSError(errno.ENOTSUP, os.strerror(errno.ENOTSUP))
+        if clonefile(src_path, dst_path, 0) < 0:
+            raise _libc_error()
+        # The clone has the source's mode; make it match a copy's, before
+        # anyone can see it under its real name.
+        os.chmod(dst_path, 0o600)
+    elif sys.platform.startswith('linux'):
+        in_fd = os.open(src_path, os.O_RDONLY)
+        try:
+            out_fd = os.open(dst_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o600)
+            try:
+                _ficlone(in_fd, out_fd)
+            except OSError:
+                os.unlink(dst_path)
+                raise
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
+    else:
+        raise OSError(errno.ENOTSUP, os.strerror(errno.ENOTSUP))
+
+
+
+def _read_write_copy(in_fd, out_fd):
+    """
+    Copy the data of one open file to another through a user-space buffer.
+    """
+    while True:
+        data = os.read(in_fd, COPY_BUFFER_SIZE)
+        if not data:
+            return
+        while data:
+            data = data[os.write(out_fd, data):]
+
+
+
+def _threaded_copy(in_fd, out_fd, size):
+    """
+    Copy the C{size} bytes of one open file to another through user-space
+    buffers.
+
+    A background thread reads into one buffer while this thread writes out
+    another, so that when the files are on different devices, neither device
+    sits idle waiting for the other.
+    """
+    free = Queue()
+    full = Queue()
+    for ignored in range(COPY_BUFFER_COUNT):
+        free.put(bytearray(min(size, COPY_BUFFER_SIZE)))
+
+    def read():
+        try:
+            reader = io.FileIO(in_fd, 'r', closefd=False)
+            while True:
+                buf = free.get()
+                if buf is None:
+                    return
+                count = reader.readinto(buf)
+                full.put((buf, count))
+                if not count:
+                    return
+        except Exception as e:
+            full.put((None, e))
+
+    reading = threading.Thread(target=read)
+    reading.start()
+    try:
+        writer = io.FileIO(out_fd, 'w', closefd=False)
+        while True:
+            buf, count = full.get()
+            if buf is None:
+                # The reader failed, and sent its exception instead.
+                raise count
+            if not count:
+                return
+            data = memoryview(buf)[:count]
+            while len(data):
+                data = data[writer.write(data):]
+            free.put(buf)
+    finally:
+        # Let the reader stop, if it's still waiting for a buffer.
+        free.put(None)
+        reading.join()
+
+
+
+def _preallocate(fd, size):
+    """
+    Reserve C{size} bytes of space for the empty file open as C{fd}, in as few
+    extents as possible, so that filling it in doesn't fragment it.  This is
+    only an optimization, so failure is ignored.
+    """
+    if size == 0:
+        return
+    if sys.platform == 'darwin':
+        for flags in (F_ALLOCATECONTIG | F_ALLOCATEALL, F_ALLOCATEALL):
+            fstore = struct.pack('Iiqqq', flags, F_PEOFPOSMODE, 0, size, 0)
+            try:
+                fcntl.fcntl(fd, F_PREALLOCATE, fstore)
+            except IOError:
+                continue
+            return
+    elif sys.platform.startswith('linux'):
+        # fallocate(2) rather than posix_fallocate(3), which, where the
+        # filesystem can't preallocate, would write out the whole file.
+        LIBC.fallocate64(fd, 0, 0, size)
+
+
+
+def _bypass_cache(fd):
+    """
+    Ask Darwin not to keep the data read from or written to C{fd} in the
+    buffer cache: it's never read again, and would only push postgres's own
+    data out.  This is only an optimization, so failure is ignored.
+    """
+    if sys.platform == 'darwin':
+        try:
+            fcntl.fcntl(fd, F_NOCACHE, 1)
+        except IOError:
+            pass
+
+
+
+def _sync_and_evict(in_fd, out_fd):
+    """
+    Make sure that the copy open as C{out_fd} is on disk, then, where the
+    platform allows it, let the kernel drop the cached pages of both it and
+    the original open as C{in_fd}, since the archiver won't read either again.
+    """
+    if sys.platform == 'darwin':
+        # Darwin's fsync(2) leaves the data in the drive's write cache.
+        try:
+            fcntl.fcntl(out_fd, fcntl.F_FULLFSYNC)
+        except IOError:
+            # Not every filesystem supports it; do the best we can.
+            os.fsync(out_fd)
+    else:
+        getattr(os, 'fdatasync', os.fsync)(out_fd)
+    if sys.platform.startswith('linux'):
+        # Only advice, so there's nothing to do if it's not taken.
+        LIBC.posix_fadvise64(out_fd, 0, 0, POSIX_FADV_DONTNEED)
+        LIBC.posix_fadvise64(in_fd, 0, 0, POSIX_FADV_DONTNEED)
+
+
+
+def _sendfile(in_fd, out_fd, size):
+    """
+    Copy C{size} bytes from the start of C{in_fd} to C{out_fd} with Linux's
+    C{sendfile(2)}.
+
+    @return: L{False} if nothing was copied because this kernel can't
+        C{sendfile()} to a file; L{True} otherwise.
+    """
+    offset = ctypes.c_int64(0)
+    while offset.value < size:
+        sent = LIBC.sendfile64(out_fd, in_fd, ctypes.byref(offset),
+                               min(size - offset.value, SENDFILE_CHUNK))
+        if sent < 0:
+            error = _libc_error()
+            if offset.value == 0 and error.errno in (errno.EINVAL,
+                                                     errno.ENOSYS):
+                return False
+            raise error
+        if sent == 0:
+            break
+    return True
+
+
+
+def _mmap_copy(in_fd, out_fd, size):
+    """
+    Copy C{size} bytes from the start of C{in_fd} to C{out_fd}, which must be
+    open for reading as well as writing, by mapping both into memory.  For a
+    small file, such as a timeline's C{.history}, this takes fewer system
+    calls than any of the other ways.
+    """
+    os.ftruncate(out_fd, size)
+    src = mmap.mmap(in_fd, size, prot=mmap.PROT_READ)
+    try:
+        dst = mmap.mmap(out_fd, size)
+        try:
+            dst[:] = src[:]
+        finally:
+            dst.close()
+    finally:
+        src.close()
+
+
+
+def _copy_fd(in_fd, out_fd, size):
+    """
+    Copy C{size} bytes from the start of C{in_fd} to C{out_fd}, which must be
+    open for reading as well as writing, keeping the data inside the kernel
+    wherever the platform allows it.
+
+    Small files are simply mapped into memory and copied there.  Otherwise,
+    where C{sendfile(2)} can't be used (Darwin's can only write to a socket),
+    files on different devices are copied by L{_threaded_copy}, which keeps
+    both devices busy at once; files on the same device gain nothing from
+    that, and are copied by C{fcopyfile(3)} on Darwin, or by hand.
+    """
+    linux = sys.platform.startswith('linux')
+    if 0 < size < MMAP_COPY_LIMIT:
+        _mmap_copy(in_fd, out_fd, size)
+    elif linux and _sendfile(in_fd, out_fd, size):
+        pass
+    elif os.fstat(in_fd).st_dev != os.fstat(out_fd).st_dev:
+        _threaded_copy(in_fd, out_fd, size)
+    elif sys.platform == 'darwin':
+        _fcopyfile(in_fd, out_fd)
+    else:
+        _read_write_copy(in_fd, out_fd)
+
+
+
+def _sendfile_copy(src_path, dst_path):
+    """
+    Copy the file at C{src_path} to a new file, accessible only by its owner,
+    at C{dst_path}.
+
+    @param src_path: The path of the file to copy.
+    @type src_path: L{bytes}
+
+    @param dst_path: The path of the copy; nothing may exist there yet.
+    @type dst_path: L{bytes}
+    """
+    in_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        out_fd = os.open(dst_path, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                         0o600)
+        try:
+            size = os.fstat(in_fd).st_size
+            _bypass_cache(in_fd)
+            _bypass_cache(out_fd)
+            _preallocate(out_fd, size)
+            _copy_fd(in_fd, out_fd, size)
+            _sync_and_evict(in_fd, out_fd)
+        finally:
+            os.close(out_fd)
+    finally:
+        os.close(in_fd)
+
+
+
+class UnterminatedInput(Exception):
+    """
+    Input ended partway through a NUL-terminated string.
+    """
+
+
+
+def _read_nul_terminated(fd):
+    """
+    Generate each NUL-terminated string read from C{fd}, as soon as all of it
+    has arrived.
+
+    @raise UnterminatedInput: with the partial string, if C{fd} reaches EOF
+        partway through one.
+    """
+    pending = ''
+    while True:
+        data = os.read(fd, 65536)
+        if not data:
+            if pending:
+                raise UnterminatedInput(pending)
+            return
+        strings = (pending + data).split('\0')
+        pending = strings.pop()
+        for string in strings:
+            yield string
+
+
+
 class XPGArchive(object):
     def __init__(self, reactor):
         self.reactor = reactor
 
 
     def do_everything(self, argv, environ):
-        fromPath = FilePath(argv[2])
-        toPath = FilePath(argv[3])
+        if argv[1] == 'archive-batch':
+            return self.archive_batch(0, 1)
+        return self.archive(argv[2], argv[3])
+
+
+    def archive_batch(self, in_fd, out_fd):
+        """
+        Archive each segment named by the NUL-terminated source and
+        destination paths read from C{in_fd}, writing a line with the status
+        and source path of each to C{out_fd} once it's done, so that one
+        process can archive any number of segments.
+
+        @return: 0 if every segment was archived, 1 otherwise.
+        """
+        status = 0
+        strings = _read_nul_terminated(in_fd)
+        while True:
+            src = dst = None
+            try:
+                src = next(strings, None)
+                if src is None:
+                    return status
+                dst = next(strings, None)
+            except UnterminatedInput as e:
+                if src is None:
+                    src = e.args[0]
+            if dst is None:
+                os.write(2, "{0!r}: input ended before its destination\n"
+                         .format(src))
+                os.write(out_fd, "1 {0}\n".format(src))
+                return 1
+            try:
+                result = self.archive(src, dst)
+            except:
+                Failure().printTraceback()
+                result = 1
+            status = status or result
+            os.write(out_fd, "{0} {1}\n".format(result, src))
+
+
+    def archive(self, src, dst):
+        """
+        Archive the WAL segment at C{src} to C{dst}.
+
+        @return: 0
+        """
+        # postgres retries archive_command until it succeeds, so the archive
+        # may already be here.  One stat() of each side is as cheap as that
+        # check gets: nothing on the destination can vouch for the source
+        # without looking at the source too.
+        src_st = os.stat(src)
+        try:
+            dst_st = os.stat(dst)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            dst_st = None
 
-        if toPath.exists() and toPath.getsize() == fromPath.getsize():
+        if dst_st is not None and dst_st.st_size == src_st.st_size:
             # Already exists, and it's the right size.  OK.
-            sys.stderr.write("{0!r} === {1!r}\n".format(fromPath.path,
-                                                        toPath.path))
+            os.write(2, "{0!r} === {1!r}\n".format(src, dst))
         else:
-            sys.stderr.write("{0!r} ... {1!r}\n".format(fromPath.path,
-                                                        toPath.path))
-            temporary = toPath.temporarySibling(TEMP_EXT)
-            fromPath.copyTo(temporary)
-            temporary.moveTo(toPath)
-            toPath.chmod(0o600)
-            sys.stderr.write("{0!r} --> {1!r}\n".format(fromPath.path,
-                                                        toPath.path))
-        return succeed(None)
+            temporary = "{0}.{1}{2}".format(dst, os.getpid(), TEMP_EXT)
+            try:
+                try:
+                    _clone_file(src, temporary)
+                except OSError as e:
+                    if e.errno not in CLONE_UNSUPPORTED:
+                        raise
+                    _sendfile_copy(src, temporary)
+                os.rename(temporary, dst)
+            except:
+                # Don't leave it behind to block the next attempt, which will
+                # use the same name if it's made by this process.
+                if os.path.lexists(temporary):
+                    os.unlink(temporary)
+                raise
+            # Both lines at once, to keep the log to one write per segment.
+            os.write(2, "{0!r} ... {1!r}\n{0!r} --> {1!r}\n"
+                     .format(src, dst))
+        return 0
 
 
 
-@inlineCallbacks
-def main(reactor, argv, environ):
+DISPATCH = {
+    'ctl': XPGCtl,
+    'archive': XPGArchive,           # archive_command case.
+    'archive-batch': XPGArchive,
+    '': XPostgres,
+}
+
+
+
+def dispatch_token(argv, environ):
+    """
+    Work out how this process was invoked.
+
+    @return: the key in L{DISPATCH} of the class which should handle it.
+    """
     if '_ctl' in argv[0] or environ.pop('BEHAVE_AS_XPG_CTL', False):
-        xpg = XPGCtl(reactor)
-    elif len(argv) > 1 and argv[1] == 'archive':
-        # archive_command case.
-        xpg = XPGArchive(reactor)
-    else:
-        xpg = XPostgres(reactor)
+        return 'ctl'
+    if len(argv) > 1 and argv[1] in ('archive', 'archive-batch'):
+        return argv[1]
+    return ''
+
+
+
+@inlineCallbacks
+def main(reactor, argv, environ, token=None):
+    if token is None:
+        token = dispatch_token(argv, environ)
+    xpg = DISPATCH[token](reactor)
     try:
+        if isinstance(xpg, XPGArchive):
+            # Archiving is synchronous; there's nothing to wait for.
+            returnValue(xpg.do_everything(argv, environ))
         result = yield xpg.do_everything(argv, environ)
         returnValue(result)
     finally:
@@ -1772,12 +2230,22 @@ def main(reactor, argv, environ):
 
 
 if __name__ == "__main__":
-    from twisted.internet import reactor
     from sys import argv
     from os import environ
+    token = dispatch_token(argv, environ)
+    if DISPATCH[token] is XPGArchive:
+        # archive_command runs once for every WAL segment, and archiving is
+        # just a synchronous copy, so don't even import a reactor.
+        try:
+            status = XPGArchive(None).do_everything(argv, environ)
+        except:
+            Failure().printTraceback()
+            status = 1
+        os._exit(status)
+    from twisted.internet import reactor
     exitCode = [0]
     def start():
-        ran = main(reactor, argv, environ)
+        ran = main(reactor, argv, environ, token)
         def done(result):
             if result is not None:
                 if isinstance(result, Failure):